@@ -1,31 +1,41 @@
 from __future__ import annotations
 
-import base64
 import binascii
+import hashlib
 import logging
+from collections import OrderedDict
 from io import BytesIO
+from typing import Any, Dict
 
-from fastapi import APIRouter, HTTPException
+import msgpack
+import orjson
+import pybase64
+from fastapi import APIRouter, HTTPException, Query, Request, Response
+from fastapi.exceptions import RequestValidationError
 from PIL import Image, UnidentifiedImageError
+from pydantic import ValidationError
 
 from apps.calculator.utils import read_skribbl
-from schema import ImageData
+from schema import ImageBlob, ImageData, Subject
 
 logger = logging.getLogger("aicalc.route")
 router = APIRouter()
 
+_b64decode = pybase64.b64decode
 
-def _unpack_doodle(data_url: str) -> Image.Image:
-    if not data_url:
-        raise HTTPException(status_code=400, detail="No image data provided")
+_MAX_RAW_BYTES = 11_250_000  # decoded size of ImageData.image's 15M-char ceiling
+_MAX_BINARY_BYTES = _MAX_RAW_BYTES + 64 * 1024  # image plus msgpack framing and options
+_MAX_JSON_BYTES = 15_000_000 + 64 * 1024  # ImageData.image max_length plus the other fields
+
+# Hits are stored as ready-to-send JSON so they skip response encoding entirely.
+_RESULT_CACHE: "OrderedDict[bytes, bytes]" = OrderedDict()
+_RESULT_CACHE_MAX = 512
+_ZERO_USAGE = {"prompt_tokens": 0, "completion_tokens": 0, "total_tokens": 0}
 
-    payload = data_url.split(",", 1)[1] if "," in data_url else data_url
-    try:
-        raw = base64.b64decode(payload)
-    except (binascii.Error, ValueError) as e:
-        logger.warning("Base64 decode failed: %s", e)
-        raise HTTPException(status_code=400, detail="Invalid base64 image data") from e
 
+def _open_doodle(raw: bytes) -> Image.Image:
+    if not raw:
+        raise HTTPException(status_code=400, detail="No image data provided")
     try:
         return Image.open(BytesIO(raw))
     except UnidentifiedImageError as e:
@@ -33,18 +43,47 @@ def _unpack_doodle(data_url: str) -> Image.Image:
         raise HTTPException(status_code=400, detail="Unsupported image format") from e
 
 
-@router.post("")
-@router.post("/")
-async def calculate(data: ImageData):
-    image = _unpack_doodle(data.image)
-    subject = (data.subject or "math").lower()
-    dict_of_vars = data.dict_of_vars or {}
+def _unpack_doodle(payload: str) -> bytes:
+    if not payload:
+        raise HTTPException(status_code=400, detail="No image data provided")
 
-    logger.info(
+    try:
+        raw = _b64decode(payload, validate=False)
+    except (binascii.Error, ValueError) as e:
+        logger.warning("Base64 decode failed: %s", e)
+        raise HTTPException(status_code=400, detail="Invalid base64 image data") from e
+    return raw
+
+
+def _cache_key(raw: bytes, subject: str, dict_of_vars: Dict[str, Any], include_steps: bool) -> bytes:
+    vars_key = orjson.dumps(dict_of_vars, option=orjson.OPT_SORT_KEYS)
+    return b"|".join((
+        hashlib.blake2b(raw, digest_size=16).digest(),
+        subject.encode(),
+        b"1" if include_steps else b"0",
+        vars_key,
+    ))
+
+
+async def _solve(
+    raw: bytes,
+    subject: str,
+    dict_of_vars: Dict[str, Any],
+    include_steps: bool,
+) -> Response:
+    key = _cache_key(raw, subject, dict_of_vars, include_steps)
+    cached = _RESULT_CACHE.get(key)
+    if cached is not None:
+        _RESULT_CACHE.move_to_end(key)
+        logger.debug("Cache hit | subject=%s", subject)
+        return Response(content=cached, media_type="application/json")
+
+    image = _open_doodle(raw)
+    logger.debug(
         "Analyzing image | subject=%s | vars=%d | steps=%s",
         subject,
         len(dict_of_vars),
-        data.include_steps,
+        include_steps,
     )
 
     try:
@@ -52,7 +91,8 @@ async def calculate(data: ImageData):
             image,
             dict_of_vars=dict_of_vars,
             subject=subject,
-            include_steps=data.include_steps,
+            include_steps=include_steps,
+            raw=raw,
         )
         responses = data_out.get("results", [])
         usage = data_out.get("usage", {})
@@ -61,14 +101,104 @@ async def calculate(data: ImageData):
         raise HTTPException(status_code=502, detail=f"AI analysis failed: {e}") from e
 
     if not responses:
-        return {"message": "No results found", "data": [], "usage": usage, "status": "warning"}
+        body = orjson.dumps({"message": "No results found", "data": [], "usage": usage, "status": "warning"})
+        return Response(content=body, media_type="application/json")
 
     result_data = [r for r in responses if isinstance(r, dict)]
-    logger.info("Returning %d results | tokens=%d", len(result_data), usage.get("total_tokens", 0))
-    return {
+    logger.debug("Returning %d results | tokens=%d", len(result_data), usage.get("total_tokens", 0))
+    result = {
         "message": "Image processed successfully",
         "data": result_data,
         "usage": usage,
         "status": "success",
     }
+    # Nothing is sent to Gemini on a hit, so replay it with zero usage rather than the original count.
+    _RESULT_CACHE[key] = orjson.dumps({**result, "usage": _ZERO_USAGE})
+    if len(_RESULT_CACHE) > _RESULT_CACHE_MAX:
+        _RESULT_CACHE.popitem(last=False)
+    # Returning a Response skips FastAPI's jsonable_encoder walk over the results.
+    return Response(content=orjson.dumps(result), media_type="application/json")
+
+
+async def _slurp(request: Request, limit: int) -> bytes:
+    body = bytearray()
+    async for chunk in request.stream():
+        body.extend(chunk)
+        if len(body) > limit:
+            raise HTTPException(status_code=413, detail="Image too large")
+    return bytes(body)
+
+
+def _body_errors(e: ValidationError) -> RequestValidationError:
+    # Match FastAPI's own body validation: locations are rooted at "body" and carry no docs URL.
+    return RequestValidationError(
+        [{**err, "loc": ("body", *err["loc"])} for err in e.errors(include_url=False)]
+    )
+
+
+def _missing_body() -> RequestValidationError:
+    return RequestValidationError(
+        [{"type": "missing", "loc": ("body",), "msg": "Field required", "input": None}]
+    )
+
+
+_IMAGE_DATA_BODY = {
+    "requestBody": {
+        "required": True,
+        "content": {"application/json": {"schema": ImageData.model_json_schema()}},
+    }
+}
+
+
+@router.post("", openapi_extra=_IMAGE_DATA_BODY)
+@router.post("/", openapi_extra=_IMAGE_DATA_BODY)
+async def calculate(request: Request):
+    # Validate straight from the body bytes with pydantic-core's JSON parser instead of
+    # json.loads + model validation, which walks the multi-MB base64 string twice.
+    body = await _slurp(request, _MAX_JSON_BYTES)
+    if not body:
+        raise _missing_body()
+    try:
+        data = ImageData.model_validate_json(body)
+    except ValidationError as e:
+        raise _body_errors(e) from e
+
+    raw = _unpack_doodle(data.payload)
+    return await _solve(raw, data.subject, data.dict_of_vars or {}, data.include_steps)
+
+
+@router.post("/raw")
+async def calculate_raw(
+    request: Request,
+    subject: Subject = "math",
+    dict_of_vars: str = Query("{}", description="JSON object of known variables"),
+    include_steps: bool = True,
+):
+    try:
+        known_vars = orjson.loads(dict_of_vars) if dict_of_vars else {}
+    except orjson.JSONDecodeError as e:
+        raise HTTPException(status_code=400, detail="dict_of_vars must be a JSON object") from e
+    if not isinstance(known_vars, dict):
+        raise HTTPException(status_code=400, detail="dict_of_vars must be a JSON object")
+
+    body = await _slurp(request, _MAX_RAW_BYTES)
+    return await _solve(body, subject, known_vars, include_steps)
+
+
+@router.post("/binary")
+async def calculate_binary(request: Request):
+    body = await _slurp(request, _MAX_BINARY_BYTES)
+    if not body:
+        raise _missing_body()
+    try:
+        payload = msgpack.unpackb(body, raw=False)
+    except (msgpack.UnpackException, ValueError) as e:
+        logger.warning("msgpack decode failed: %s", e)
+        raise HTTPException(status_code=400, detail="Invalid msgpack body") from e
+
+    try:
+        data = ImageBlob.model_validate(payload)
+    except ValidationError as e:
+        raise _body_errors(e) from e
 
+    return await _solve(data.image, data.subject, data.dict_of_vars or {}, data.include_steps)
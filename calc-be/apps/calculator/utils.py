@@ -1,17 +1,18 @@
 from __future__ import annotations
 
 import asyncio
-import json
 import logging
 import re
 from io import BytesIO
-from typing import Any, Dict, List, Optional
+from typing import Any, Dict, List, Optional, Tuple, get_args
 
+import orjson
 from google import genai
 from google.genai import types
 from PIL import Image
 
 from constants import GEMINI_API_KEYS, GEMINI_MODEL
+from schema import Subject
 
 logger = logging.getLogger("aicalc.utils")
 
@@ -28,6 +29,10 @@ async def _gemini_pal() -> Optional[genai.Client]:
     if not GEMINI_API_KEYS:
         logger.error("No GEMINI_API_KEYS found in environment!")
         return None
+    # Fast path: the client is built once per key and reused; only construction needs the lock.
+    client = _genai_client
+    if client is not None:
+        return client
     async with _key_lock:
         if _genai_client is None:
             key = GEMINI_API_KEYS[_key_index]
@@ -60,40 +65,93 @@ def _realm_prompt(subject: str) -> str:
     )
 
 
-def _spell_prompt(
-    subject: str, dict_of_vars: Dict[str, Any], *, include_steps: bool = True
-) -> str:
-    vars_json = json.dumps(dict_of_vars or {}, ensure_ascii=False)
-    if include_steps:
-        steps_rule = "Provide a concise 'steps' array where each item has an 'explanation' field using LaTeX for math."
-    else:
-        steps_rule = "Do NOT include a 'steps' array in your response. Return only 'expr', 'result', and 'assign'."
+_SUBJECTS = get_args(Subject)
+_DEFAULT_SUBJECT = "math"
+_STEPS_RULES = {
+    True: "Provide a concise 'steps' array where each item has an 'explanation' field using LaTeX for math.",
+    False: "Do NOT include a 'steps' array in your response. Return only 'expr', 'result', and 'assign'.",
+}
+
+
+def _prompt_tail(subject: str, include_steps: bool) -> str:
     return (
-        f"Variables: {vars_json}. {steps_rule} "
+        f". {_STEPS_RULES[include_steps]} "
         "FORMAT: JSON array: [{'expr': 'LaTeX string', 'result': 'LaTeX string', 'assign': bool, 'steps': []}]. "
         "No prose or markdown. Always use LaTeX for math symbols. Do not include LaTeX delimiters like $ or $$. " + _realm_prompt(subject)
     )
 
 
-_FENCE_RE = re.compile(r"^```[a-zA-Z]*\n?|\n?```$", re.MULTILINE)
+# Everything after the variables JSON is static per (subject, include_steps), so build it once.
+_PROMPT_TAILS: Dict[tuple, str] = {
+    (subject, steps): _prompt_tail(subject, steps) for subject in _SUBJECTS for steps in (True, False)
+}
+
+
+def _spell_prompt(
+    subject: str, dict_of_vars: Dict[str, Any], *, include_steps: bool = True
+) -> str:
+    # orjson accepts less than json.dumps did (no bytes, non-str keys or ints of 64+ bits);
+    # schema.JsonVars rejects those at validation time so they never reach this call.
+    vars_json = orjson.dumps(dict_of_vars or {}).decode("utf-8")
+    tail = _PROMPT_TAILS.get((subject, include_steps)) or _PROMPT_TAILS[(_DEFAULT_SUBJECT, include_steps)]
+    return "Variables: " + vars_json + tail
+
+
+_FENCE_RE = re.compile(r"^\s*```[a-zA-Z]*[ \t]*\n?(.*?)\n?```\s*$", re.DOTALL)
 _ARRAY_RE = re.compile(r"\[\s*\{.*?\}\s*\]", re.DOTALL)
 
 
+_MAX_VISION_DIM = 1024
+
+
+def _prep_doodle(img: Image.Image) -> Image.Image:
+    # Runs for any upload that isn't a <=1024px PNG/JPEG/WebP, whichever endpoint it came
+    # through; the web client's <=768px PNG exports (App.tsx) take _vision_blob's pass-through.
+    # Downscaled decode hint (JPEG only; a no-op for the canvas PNGs), then decode once here.
+    img.draft("RGB", (_MAX_VISION_DIM, _MAX_VISION_DIM))
+    img.load()
+    if img.mode in ("RGBA", "LA", "PA") or (img.mode == "P" and "transparency" in img.info):
+        # Flatten onto white so transparent regions don't turn black.
+        rgba = img.convert("RGBA")
+        flat = Image.new("RGB", rgba.size, (255, 255, 255))
+        flat.paste(rgba, mask=rgba.getchannel("A"))
+        img = flat
+    elif img.mode != "RGB":
+        img = img.convert("RGB")
+    if max(img.size) > _MAX_VISION_DIM:
+        img.thumbnail((_MAX_VISION_DIM, _MAX_VISION_DIM), Image.Resampling.BILINEAR)
+    return img
+
+
 def _png_blob(img: Image.Image) -> bytes:
     buf = BytesIO()
     img.save(buf, format="PNG")
     return buf.getvalue()
 
 
+_PASSTHROUGH_MIME = {"PNG": "image/png", "JPEG": "image/jpeg", "WEBP": "image/webp"}
+
+
+def _vision_blob(img: Image.Image, raw: Optional[bytes]) -> Tuple[bytes, str]:
+    # Format and size come from the header, so this check doesn't decode any pixels.
+    mime = _PASSTHROUGH_MIME.get(img.format or "")
+    if raw is not None and mime and max(img.size) <= _MAX_VISION_DIM:
+        return raw, mime
+    return _png_blob(_prep_doodle(img)), "image/png"
+
+
 def _pluck_text(response: Any) -> str:
     try:
-        if getattr(response, "text", None):
-            return response.text
-        for candidate in getattr(response, "candidates", []) or []:
-            content = getattr(candidate, "content", None)
-            parts = getattr(content, "parts", None) if content else None
+        text = response.text
+        if text:
+            return text
+    except Exception:
+        pass
+    try:
+        for candidate in response.candidates or []:
+            parts = candidate.content.parts if candidate.content else None
             if parts:
-                return "".join(getattr(p, "text", "") or "" for p in parts)
+                return "".join(p.text or "" for p in parts)
     except Exception:
         logger.exception("Failed to extract text from Gemini response")
     return ""
@@ -102,20 +160,21 @@ def _pluck_text(response: Any) -> str:
 def _parse_loot(text: str) -> Optional[List[Any]]:
     if not text:
         return None
-    cleaned = _FENCE_RE.sub("", text).strip()
+    fenced = _FENCE_RE.match(text)
+    cleaned = fenced.group(1).strip() if fenced else text.strip()
     try:
-        parsed = json.loads(cleaned)
+        parsed = orjson.loads(cleaned)
         if isinstance(parsed, list):
             return parsed
         if isinstance(parsed, dict):
             return [parsed]
-    except (json.JSONDecodeError, ValueError):
+    except orjson.JSONDecodeError:
         pass
     matches = _ARRAY_RE.findall(text)
     if matches:
         try:
-            return json.loads(matches[0])
-        except (json.JSONDecodeError, ValueError):
+            return orjson.loads(matches[0])
+        except orjson.JSONDecodeError:
             pass
     return None
 
@@ -126,12 +185,18 @@ async def read_skribbl(
     subject: str = "math",
     *,
     include_steps: bool = True,
+    raw: Optional[bytes] = None,
 ) -> Dict[str, Any]:
     client = await _gemini_pal()
     if not client:
         return {"results": [{"expr": "Error", "result": "No API key", "assign": False}], "usage": {}}
 
-    png_bytes = _png_blob(img)
+    # Decode/resize/encode is CPU-bound; keep it off the event loop so other requests keep flowing.
+    blob, mime_type = await asyncio.to_thread(_vision_blob, img, raw)
+    image_part = types.Part.from_bytes(data=blob, mime_type=mime_type)
+    # Only the encoded part is needed from here on; free the decoded pixels before the slow API call.
+    img.close()
+    base_prompt = _spell_prompt(subject, dict_of_vars or {}, include_steps=include_steps)
     usage_dict: Dict[str, Any] = {}
     last_raw_text = ""
 
@@ -139,7 +204,7 @@ async def read_skribbl(
         key_rotated = False
 
         for parse_attempt in range(2):
-            prompt = _spell_prompt(subject, dict_of_vars or {}, include_steps=include_steps)
+            prompt = base_prompt
             if parse_attempt > 0:
                 prompt += "\n\nCRITICAL: Return ONLY a valid JSON array. No explanations, no markdown, no text before or after. Start with [ and end with ]."
                 logger.warning(">>> Parse failure detected, retrying with stricter prompt (attempt %d)", parse_attempt)
@@ -147,7 +212,7 @@ async def read_skribbl(
             try:
                 response = await client.aio.models.generate_content(
                     model=_resolved_model_name,
-                    contents=[prompt, types.Part.from_bytes(data=png_bytes, mime_type="image/png")],
+                    contents=[prompt, image_part],
                 )
             except Exception as e:
                 err_msg = str(e)
@@ -6,6 +6,8 @@ load_dotenv()
 SERVER_URL = os.getenv('SERVER_URL', 'localhost')
 PORT = os.getenv('PORT', '8900')
 ENV = os.getenv('ENV', 'dev')
+LOG_LEVEL = os.getenv('LOG_LEVEL', 'INFO').upper()
+VERCEL_SCOPE = os.getenv('VERCEL_SCOPE', '').strip().lower() or None
 
 _raw_keys = os.getenv("GEMINI_API_KEY", "")
 GEMINI_API_KEYS = [k.strip() for k in _raw_keys.split(",") if k.strip()]
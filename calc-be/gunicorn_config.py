@@ -2,7 +2,7 @@ import multiprocessing
 import os
 
 port = os.environ.get("PORT", "8900")
-workers = min(multiprocessing.cpu_count() * 2 + 1, 4)
+workers = int(os.environ.get("WEB_CONCURRENCY", min(multiprocessing.cpu_count() * 2 + 1, 4)))
 worker_class = "uvicorn.workers.UvicornWorker"
 bind = f"0.0.0.0:{port}"
 timeout = 300
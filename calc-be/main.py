@@ -1,21 +1,29 @@
 import os
+import re
+import sys
 import logging
+import orjson
 import uvicorn
 from contextlib import asynccontextmanager
 from fastapi import FastAPI, Request
-from fastapi.responses import JSONResponse
+from fastapi.responses import JSONResponse, Response
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.middleware.gzip import GZipMiddleware
+from starlette.middleware.base import BaseHTTPMiddleware
 from apps.calculator.route import router as calculator_router
-from constants import ENV, PORT, SERVER_URL
+from constants import ENV, LOG_LEVEL, PORT, SERVER_URL, VERCEL_SCOPE
 
 os.environ["PROTOCOL_BUFFERS_PYTHON_IMPLEMENTATION"] = "python"
 
-logging.basicConfig(level=logging.INFO, format="%(asctime)s | %(levelname)-7s | %(message)s")
+logging.basicConfig(level=LOG_LEVEL, format="%(asctime)s | %(levelname)-7s | %(message)s")
 logger = logging.getLogger("aicalc")
 
 @asynccontextmanager
-async def lifespan(_: FastAPI):
+async def lifespan(app: FastAPI):
     logger.info("Server starting up...")
+    for mw in app.user_middleware:
+        if isinstance(mw.cls, type) and issubclass(mw.cls, BaseHTTPMiddleware):
+            logger.warning("%s is a BaseHTTPMiddleware; rewrite it as pure ASGI middleware", mw.cls.__name__)
     yield
     logger.info("Server shutting down...")
 
@@ -40,29 +48,69 @@ async def global_exception_handler(request: Request, exc: Exception):
         content={"message": "Internal Server Error", "data": [], "status": "error", "detail": detail},
     )
 
-origins = [
-    "http://localhost:3000",
-    "http://localhost:5173",
-    "http://127.0.0.1:5173",
-    "https://ai-calc-dusky.vercel.app",
+# Middleware must be pure ASGI (like CORSMiddleware). BaseHTTPMiddleware / @app.middleware("http")
+# wrap every request in extra streams, tasks and Request objects. Write new ones as:
+#
+#     class TimingMiddleware:
+#         def __init__(self, app): self.app = app
+#         async def __call__(self, scope, receive, send):
+#             if scope["type"] != "http":
+#                 return await self.app(scope, receive, send)
+#             ...  # inspect scope / wrap send, then:
+#             await self.app(scope, receive, send)
+#
+# and register with app.add_middleware(TimingMiddleware). lifespan() warns if one slips in.
+
+# One regex for every allowed origin: local dev servers, the exact production host and, if
+# VERCEL_SCOPE is set, this project's previews (ai-calc-<hash>-<scope>, ai-calc-git-<branch>-<scope>).
+# Vercel project names are global, so previews must be anchored to our team scope suffix; a bare
+# ai-calc-*.vercel.app would also match other people's deployments.
+_ORIGIN_PATTERNS = [
+    r"http://(localhost:(3000|5173)|127\.0\.0\.1:5173)",
+    r"https://ai-calc-dusky\.vercel\.app",
 ]
+if VERCEL_SCOPE:
+    _ORIGIN_PATTERNS.append(rf"https://ai-calc-([a-z0-9]+|git-[a-z0-9-]+)-{re.escape(VERCEL_SCOPE)}\.vercel\.app")
+_ORIGIN_RE = re.compile("|".join(_ORIGIN_PATTERNS))  # Starlette fullmatches it once per request
 
 app.add_middleware(
     CORSMiddleware,
-    allow_origins=["*"] if ENV == "dev" else origins,
-    allow_credentials=True if ENV != "dev" else False,
-    allow_methods=["*"],
-    allow_headers=["*"],
+    allow_origins=["*"] if ENV == "dev" else [],
+    allow_origin_regex=None if ENV == "dev" else _ORIGIN_RE.pattern,
+    allow_credentials=False,  # the frontend never sends cookies or auth headers
+    allow_methods=["GET", "POST"],
+    allow_headers=["Content-Type"],
+    max_age=86400,
 )
+# Solutions with steps run to several KB of LaTeX-heavy JSON; tiny bodies like /healthz stay raw.
+app.add_middleware(GZipMiddleware, minimum_size=1024, compresslevel=5)
+
+# Health probes hit this constantly; encode the body once. A fresh Response per call is still
+# needed because middleware (CORS) appends to the response's header list in place.
+_HEALTH_BODY = orjson.dumps({"status": "ok", "version": app.version})
 
-@app.get("/")
-@app.get("/healthz")
+@app.get("/", response_class=Response)
+@app.get("/healthz", response_class=Response)
 async def health():
-    return {"status": "ok", "version": "2.0.0"}
+    return Response(content=_HEALTH_BODY, media_type="application/json")
 
 app.include_router(calculator_router, prefix="/calculate")
 
 if __name__ == "__main__":
     port = int(os.environ.get("PORT", PORT))
     host = "0.0.0.0" if os.environ.get("PORT") else SERVER_URL
-    uvicorn.run("main:app", host=host, port=port, reload=(ENV == "dev"))
+    # Render sets RENDER=true; never run the reloader there, even if ENV is misconfigured as dev.
+    # (PORT can't be the signal: the README's local .env sets it too.)
+    reload = ENV == "dev" and not os.environ.get("RENDER")
+    if not reload:
+        # Hand off to gunicorn so requests spread across worker processes (see gunicorn_config.py).
+        here = os.path.dirname(os.path.abspath(__file__))
+        os.execvp(sys.executable, [
+            sys.executable, "-m", "gunicorn", "main:app",
+            "--chdir", here,
+            "-c", os.path.join(here, "gunicorn_config.py"),
+            "--bind", f"{host}:{port}",
+        ])
+    # uvloop isn't available on Windows; uvicorn[standard] only installs it elsewhere.
+    loop = "asyncio" if sys.platform == "win32" else "uvloop"
+    uvicorn.run("main:app", host=host, port=port, reload=reload, loop=loop, http="httptools")
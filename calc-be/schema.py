@@ -1,9 +1,41 @@
-from pydantic import BaseModel, Field
-from typing import Literal
+from functools import cached_property
+import orjson
+from pydantic import AfterValidator, BaseModel, ConfigDict, Field
+from typing import Annotated, Literal
+
+Subject = Literal["math", "physics", "chemistry"]
+
+
+# dict_of_vars ends up in orjson.dumps (prompt and cache key), which rejects bytes, ext types,
+# non-str keys and ints of 64+ bits; catch those here so they come back as a 422, not a 5xx.
+def _json_only(v: dict) -> dict:
+    try:
+        orjson.dumps(v)
+    except orjson.JSONEncodeError as e:
+        raise ValueError(f"dict_of_vars must be JSON-serializable: {e}") from e
+    return v
+
+
+JsonVars = Annotated[dict, AfterValidator(_json_only)]
 
 class ImageData(BaseModel):
+    model_config = ConfigDict(frozen=True)
+
     image: str = Field(..., max_length=15_000_000)
-    dict_of_vars: dict = Field(default_factory=dict)
-    subject: Literal["math", "physics", "chemistry"] = "math"
+    dict_of_vars: JsonVars = Field(default_factory=dict)
+    subject: Subject = "math"
     include_steps: bool = True
 
+    # Plain cached_property (not computed_field) so the multi-MB string is never serialized twice.
+    @cached_property
+    def payload(self) -> str:
+        comma = self.image.find(",", 0, 64)  # the data-URI header is short; don't scan the payload
+        return self.image if comma == -1 else self.image[comma + 1:]
+
+class ImageBlob(BaseModel):
+    model_config = ConfigDict(frozen=True)
+
+    image: bytes = Field(..., max_length=11_250_000)
+    dict_of_vars: JsonVars = Field(default_factory=dict)
+    subject: Subject = "math"
+    include_steps: bool = True